@@ -20,12 +20,14 @@ install_requires = [
     'woodwork>=0.31.0',  # Required for featuretools 1.0+ compatibility
     'xgboost>=2.0.0',
     'shap>=0.43.0',
+    'joblib>=1.2.0',
 
     # Flask stack - updated to latest stable versions
     'flask>=2.3.0',
     'flask-restful>=0.3.10',
     'flask-cors>=4.0.0',
     'flasgger>=0.9.7.1',
+    'orjson>=3.8.0',
     
     # Additional core dependencies
     'python-dateutil>=2.8.0',  # Required for pandas date functionality
@@ -41,6 +43,16 @@ tests_require = [
     'pytest-cov>=4.1.0',
 ]
 
+compress_requires = [
+    # compressed api responses
+    'flask-compress>=1.15',
+]
+
+numba_requires = [
+    # compiled kernels for the featurization primitives
+    'numba>=0.57.0',
+]
+
 development_requires = [
     # general
     'bumpversion>=0.6.0',
@@ -90,6 +102,8 @@ setup(
                 'package.',
     extras_require={
         'test': tests_require,
+        'numba': numba_requires,
+        'compress': compress_requires,
         'dev': development_requires + tests_require,
     },
     install_package_data=True,
@@ -6,6 +6,13 @@ __author__ = 'MIT Data To AI Lab'
 __email__ = 'dailabmit@gmail.com'
 __version__ = '0.1.0.dev0'
 
-from .core import VBridge, train_model
-
 __all__ = ['VBridge', 'train_model']
+
+
+def __getattr__(name):
+    # Import the core module lazily, so that importing the package does not pull in
+    # featuretools, shap and xgboost
+    if name in __all__:
+        from . import core
+        return getattr(core, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
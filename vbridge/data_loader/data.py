@@ -3,13 +3,100 @@ import os
 import featuretools as ft
 import pandas as pd
 import woodwork as ww
+from pandas.api.types import union_categoricals
 
 from vbridge.utils.directory_helpers import exist_entityset, load_entityset, save_entityset
 from vbridge.utils.entityset_helpers import remove_nan_entries
 
+# Known categorical columns (e.g., in the ADMISSIONS table)
+CATEGORICAL_COLUMNS = ['ADMISSION_TYPE', 'ADMISSION_LOCATION', 'DISCHARGE_LOCATION', 'INSURANCE',
+                       'RELIGION', 'MARITAL_STATUS', 'ETHNICITY', 'GENDER']
+
+# Woodwork logical types of the declared column dtypes
+DTYPE_LOGICAL_TYPES = {
+    'category': ww.logical_types.Categorical,
+    'float64': ww.logical_types.Double,
+}
+
+# Woodwork logical types of the undeclared columns, by the kind of their parsed dtypes
+KIND_LOGICAL_TYPES = {
+    'M': ww.logical_types.Datetime,
+    'i': ww.logical_types.Integer,
+    'u': ww.logical_types.Integer,
+    'f': ww.logical_types.Double,
+    'b': ww.logical_types.Boolean,
+    'O': ww.logical_types.NaturalLanguage,
+}
+
+# Number of rows per chunk when streaming large tables
+LARGE_TABLE_CHUNKSIZE = 1_000_000
+
+# In-process cache of the built entity sets, keyed by the dataset id and the source tables' mtimes
+_ES_CACHE = {}
+
+
+def get_table_mtimes(entity_configs, table_dir):
+    """Get the modification time of each table's csv file (None if the file does not exist)."""
+    mtimes = {}
+    for table_name in entity_configs:
+        path = os.path.join(table_dir, f'{table_name}.csv')
+        mtimes[table_name] = os.path.getmtime(path) if os.path.exists(path) else None
+    return mtimes
+
+
+def get_column_dtypes(info, index_columns, key_columns):
+    """Get the dtypes of the columns declared in an entity's configuration.
+
+    The identifiers that link the entity to others and the known categorical columns are read as
+    pandas categoricals, the other identifiers (e.g., the ROW_ID of each record) as strings and
+    value columns as floats. Numeric columns are not downcast (e.g., to float32), since
+    Woodwork's Integer and Double logical types store int64/float64 and would cast them back.
+    """
+    dtypes = {col: 'category' for col in CATEGORICAL_COLUMNS}
+    dtypes.update({col: 'float64' for col in info.get('value_indexes', [])})
+    dtypes.update({col: 'category' if col in key_columns else 'str' for col in index_columns})
+    return dtypes
+
+
+def get_key_columns(relationships, table_name):
+    """Get the columns of a table that are linked to other tables by relationships."""
+    key_columns = set()
+    for parent, primary_key, child, foreign_key in relationships:
+        if parent == table_name:
+            key_columns.add(primary_key)
+        if child == table_name:
+            key_columns.add(foreign_key)
+    return key_columns
+
+
+def share_key_categories(tables, relationships):
+    """Give the columns linked by relationships the same categories.
+
+    Featuretools can then join the parent and child tables over the categorical codes instead of
+    comparing the identifier strings.
+    """
+    groups = []
+    for parent, primary_key, child, foreign_key in relationships:
+        group = [(parent, primary_key), (child, foreign_key)]
+        for other in [g for g in groups if set(g) & set(group)]:
+            groups.remove(other)
+            group = other + [key for key in group if key not in other]
+        groups.append(group)
+
+    for group in groups:
+        group = [(table, col) for table, col in group
+                 if table in tables and col in tables[table]
+                 and isinstance(tables[table][col].dtype, pd.CategoricalDtype)]
+        if len(group) < 2:
+            continue
+        categories = union_categoricals([tables[table][col] for table, col in group],
+                                        sort_categories=True).categories
+        for table, col in group:
+            tables[table][col] = tables[table][col].cat.set_categories(categories)
+
 
 def create_entityset(dataset_id, entity_configs, relationships, table_dir, load_exist=True,
-                     save=True, verbose=True):
+                     save=True, verbose=True, large_table_threshold_mb=512):
     """Create a featuretools EntitySet from the dataset configuration.
     
     Args:
@@ -17,16 +104,26 @@ def create_entityset(dataset_id, entity_configs, relationships, table_dir, load_
         entity_configs (dict): Configuration for each entity in the dataset
         relationships (list): List of relationships between entities
         table_dir (str): Directory containing the CSV files
-        load_exist (bool): Whether to load existing entityset
+        load_exist (bool): Whether to reuse the entityset built earlier in this process or
+            pickled on disk (pickles older than the CSV files are ignored)
         save (bool): Whether to save the created entityset
         verbose (bool): Whether to print progress information
+        large_table_threshold_mb (float): CSV files larger than this are streamed in chunks
     """
-    if load_exist and exist_entityset(dataset_id):
+    mtimes = get_table_mtimes(entity_configs, table_dir)
+    signature = (dataset_id, tuple(sorted(mtimes.items())))
+    if load_exist and signature in _ES_CACHE:
+        return _ES_CACHE[signature]
+
+    if load_exist and exist_entityset(dataset_id, mtimes):
         es = load_entityset(dataset_id)
     else:
         es = ft.EntitySet(id=dataset_id)
         
-        # Add the entities to the entityset
+        # Load the tables before adding them to the entityset, so that the columns linked by
+        # relationships can share their categories
+        tables = {}
+        table_kwargs = {}
         for table_name, info in entity_configs.items():
             # Safely get date columns for parsing
             time_index = info.get('time_index')
@@ -48,43 +145,14 @@ def create_entityset(dataset_id, entity_configs, relationships, table_dir, load_
                 elif isinstance(secondary_index, str):
                     date_columns.append(secondary_index)
             
-            # For mimic-demo, convert date column names to lowercase first, 
-            # since the CSV files might have lowercase column names
+            # For mimic-demo, the CSV files have lowercase column names, so read them with the
+            # uppercase names used by the schema
+            path = os.path.join(table_dir, f'{table_name}.csv')
+            columns = pd.read_csv(path, nrows=0).columns.tolist()
             if dataset_id == 'mimic-demo':
-                date_columns_lower = [col.lower() for col in date_columns]
-            else:
-                date_columns_lower = date_columns
-                
-            # Read CSV with explicit datetime parsing - try lowercase first for mimic-demo
-            try:
-                table_df = pd.read_csv(
-                    os.path.join(table_dir, f'{table_name}.csv'),
-                    parse_dates=date_columns_lower if dataset_id == 'mimic-demo' else date_columns,
-                    low_memory=False  # Added for better memory handling
-                )
-            except ValueError as e:
-                if "Missing column provided to 'parse_dates'" in str(e):
-                    # If parsing with lowercase fails, try without date parsing and handle it later
-                    table_df = pd.read_csv(
-                        os.path.join(table_dir, f'{table_name}.csv'),
-                        low_memory=False
-                    )
-                else:
-                    raise e
-            
-            if dataset_id == 'mimic-demo':
-                table_df.columns = [col.upper() for col in table_df.columns]
-                
-                # Now try to convert the date columns to datetime after uppercase conversion
-                for date_col in date_columns:
-                    if date_col in table_df.columns:
-                        try:
-                            table_df[date_col] = pd.to_datetime(table_df[date_col], errors='coerce')
-                        except Exception:
-                            pass  # Skip if conversion fails
-            
-            # Remove entries with missing identifiers
-            index = info.get('index', table_df.columns[0])
+                columns = [col.upper() for col in columns]
+
+            index = info.get('index', columns[0])
             identifiers = info.get('identifiers', [])
             
             # Ensure identifiers is a list
@@ -94,50 +162,67 @@ def create_entityset(dataset_id, entity_configs, relationships, table_dir, load_
                 identifiers = []
             
             index_columns = identifiers + [index]
-            table_df = remove_nan_entries(table_df, index_columns, verbose=verbose)
-
-            # Convert identifiers to strings
-            for col in index_columns:
-                if col in table_df.columns:
-                    table_df[col] = table_df[col].astype('str')
-
-            # Prepare logical types for Woodwork
-            logical_types = {}
-            for col, dtype in table_df.dtypes.items():
-                if pd.api.types.is_datetime64_any_dtype(dtype):
-                    logical_types[col] = ww.logical_types.Datetime
-                elif pd.api.types.is_numeric_dtype(dtype):
-                    if pd.api.types.is_integer_dtype(dtype):
-                        logical_types[col] = ww.logical_types.Integer
-                    else:
-                        logical_types[col] = ww.logical_types.Double
-                elif pd.api.types.is_object_dtype(dtype):
-                    # Use Categorical for meaningful categorical columns, but avoid auto-interesting values
-                    # Special handling for known categorical columns in ADMISSIONS table
-                    categorical_cols = ['ADMISSION_TYPE', 'ADMISSION_LOCATION', 'DISCHARGE_LOCATION', 
-                                      'INSURANCE', 'RELIGION', 'MARITAL_STATUS', 'ETHNICITY', 'GENDER']
-                    if col in categorical_cols:
-                        logical_types[col] = ww.logical_types.Categorical
-                    else:
-                        # Use NaturalLanguage for other text columns to avoid issues
-                        logical_types[col] = ww.logical_types.NaturalLanguage
 
-            es.add_dataframe(
-                                     dataframe=table_df,
-                dataframe_name=table_name,
-                                     index=index,
+            # Declare the column types up front so that the parser does not need to infer them
+            dtypes = get_column_dtypes(info, index_columns,
+                                       get_key_columns(relationships, table_name))
+            column_dtypes = {col: dtype for col, dtype in dtypes.items() if col in columns}
+            parse_dates = [col for col in date_columns if col in columns]
+            read_kwargs = dict(
+                header=0,
+                names=columns,
+                dtype=column_dtypes,
+                parse_dates=parse_dates,
+                engine='c',
+                # The undeclared columns are inferred from the whole file, since inferring them
+                # block by block can mix numbers and text in a column (e.g., VALUE)
+                low_memory=set(columns) <= set(column_dtypes) | set(parse_dates)
+            )
+            if os.path.getsize(path) > large_table_threshold_mb * 2 ** 20:
+                # Stream large tables (e.g., CHARTEVENTS) and remove the entries with missing
+                # identifiers chunk by chunk before concatenating
+                n_rows = 0
+                chunks = []
+                for chunk in pd.read_csv(path, chunksize=LARGE_TABLE_CHUNKSIZE, **read_kwargs):
+                    n_rows += len(chunk)
+                    chunks.append(remove_nan_entries(chunk, index_columns, verbose=False))
+                # The chunks' categoricals have different categories, which concat turns into
+                # object columns
+                table_df = pd.concat(chunks)
+                table_df = table_df.astype({col: dtype for col, dtype in read_kwargs['dtype'].items()
+                                            if dtype == 'category'})
+                if verbose:
+                    print("Prune ({}/{}) rows.".format(n_rows - len(table_df), n_rows))
+            else:
+                table_df = pd.read_csv(path, **read_kwargs)
+                # Remove entries with missing identifiers
+                table_df = remove_nan_entries(table_df, index_columns, verbose=verbose)
+
+            # Prepare logical types for Woodwork, starting from the declared column types
+            logical_types = {col: DTYPE_LOGICAL_TYPES[dtype] for col, dtype in dtypes.items()
+                             if col in table_df.columns and dtype in DTYPE_LOGICAL_TYPES}
+            # and then from the parsed dtypes of the other columns (text columns, including the
+            # string identifiers, are treated as NaturalLanguage to avoid issues)
+            logical_types.update({col: KIND_LOGICAL_TYPES[dtype.kind]
+                                  for col, dtype in table_df.dtypes.items()
+                                  if col not in logical_types and dtype.kind in KIND_LOGICAL_TYPES})
+
+            tables[table_name] = table_df
+            table_kwargs[table_name] = dict(
+                index=index,
                 time_index=time_index if isinstance(time_index, str) else None,
                 logical_types=logical_types
             )
 
+        share_key_categories(tables, relationships)
+        for table_name, table_df in tables.items():
+            # Initialize Woodwork once with the known types, so that the entityset does not
+            # infer them again
+            table_df.ww.init(name=table_name, **table_kwargs[table_name])
+            es.add_dataframe(table_df)
+
         # Add the relationships to the entityset
-        for parent, primary_key, child, foreign_key in relationships:
-            es.add_relationship(
-                parent_dataframe_name=parent,
-                parent_column_name=primary_key,
-                child_dataframe_name=child,
-                child_column_name=foreign_key
-            )
+        es.add_relationships(relationships)
 
         # Add interesting values for categorical columns
         # Re-enabled with proper pandas compatibility handling
@@ -147,60 +232,48 @@ def create_entityset(dataset_id, entity_configs, relationships, table_dir, load_
                 interesting_values_config = info['interesting_values']
                 
                 try:
+                    column = es[table_name][item_index]
                     # Use string comparison with explicit type checking to avoid pandas ambiguity
                     if isinstance(interesting_values_config, str) and interesting_values_config == 'ALL':
-                        # Access dataframe directly (modern featuretools 1.0+ API)
-                        unique_values = es[table_name][item_index].unique()
-                        # Convert to regular python list to avoid pandas index issues
-                        interesting_values = [val for val in unique_values if pd.notna(val)]
+                        if isinstance(column.dtype, pd.CategoricalDtype):
+                            # The categories are already the unique non-null values
+                            interesting_values = column.cat.remove_unused_categories() \
+                                .cat.categories.tolist()
+                        else:
+                            interesting_values = column.dropna().unique().tolist()
                     elif isinstance(interesting_values_config, int):
-                        # Access dataframe directly (modern featuretools 1.0+ API)
-                        value_counts_result = es[table_name][item_index].value_counts()[:interesting_values_config]
-                        # Convert to regular python list to avoid pandas index issues
-                        interesting_values = [val for val in value_counts_result.index if pd.notna(val)]
+                        counts = column.value_counts(sort=True)
+                        interesting_values = counts[counts > 0].head(interesting_values_config) \
+                            .index.tolist()
                     else:
                         # Use the configured values directly, but ensure it's a plain list
                         if hasattr(interesting_values_config, '__iter__') and not isinstance(interesting_values_config, str):
                             interesting_values = list(interesting_values_config)
                         else:
                             interesting_values = [interesting_values_config]
-                    
-                    # Only add if we have values to add and skip if all are None/NaN
-                    if (interesting_values is not None 
-                        and hasattr(interesting_values, '__len__') 
-                        and len(interesting_values) > 0):
-                        # Double-check we're not passing any pandas objects that could cause issues
-                        clean_values = []
-                        for val in interesting_values:
-                            if pd.notna(val):
-                                # Convert pandas objects to native Python types
-                                if hasattr(val, 'item'):
-                                    clean_values.append(val.item())
-                                else:
-                                    clean_values.append(val)
-                        
-                        if clean_values:  # Only add if we have clean values
-                            # Convert values to strings for ITEMID columns to match data type
-                            if item_index == 'ITEMID':
-                                try:
-                                    clean_values = [str(val) for val in clean_values if pd.notna(val)]
-                                except (ValueError, TypeError):
-                                    pass  # Keep original values if conversion fails
-                            
-                            es.add_interesting_values(
-                                dataframe_name=table_name,
-                                values={item_index: clean_values}
-                            )
-                            
-                            if verbose:
-                                print(f"Added {len(clean_values)} interesting values for {table_name}.{item_index}")
-                                
+                        interesting_values = [val for val in interesting_values if pd.notna(val)]
+
+                    # Only add if we have values to add
+                    if interesting_values:
+                        # Convert values to strings for ITEMID columns to match data type
+                        if item_index == 'ITEMID':
+                            interesting_values = [str(val) for val in interesting_values]
+
+                        es.add_interesting_values(
+                            dataframe_name=table_name,
+                            values={item_index: interesting_values}
+                        )
+
+                        if verbose:
+                            print(f"Added {len(interesting_values)} interesting values for {table_name}.{item_index}")
+
                 except Exception as e:
                     if verbose:
                         print(f"Warning: Could not add interesting values for {table_name}.{item_index}: {str(e)}")
                     continue
 
         if save:
-            save_entityset(es, dataset_id)
+            save_entityset(es, dataset_id, mtimes)
 
+    _ES_CACHE[signature] = es
     return es
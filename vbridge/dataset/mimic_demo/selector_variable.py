@@ -1,6 +1,3 @@
-import featuretools as ft
-
-
 def mimic_cohort_selector(es=None):
     selector_vars = [{
         'name': 'Gender',
@@ -9,6 +6,8 @@ def mimic_cohort_selector(es=None):
         'extent': ['F', 'M']
     }]
     if es is not None:
+        import featuretools as ft
+
         # Build gender selector (feature) using modern featuretools API
         # Create the identity feature for GENDER column in PATIENTS dataframe
         gender_identity = ft.IdentityFeature(es['PATIENTS'].ww['GENDER'])
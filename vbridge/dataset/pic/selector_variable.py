@@ -1,9 +1,3 @@
-import featuretools as ft
-
-from vbridge.featurization.primitive.age_range import AgeRange
-from vbridge.featurization.primitive.date import Date
-
-
 def pic_cohort_selector(es=None):
     selector_vars = [{
         'name': 'Gender',
@@ -20,6 +14,11 @@ def pic_cohort_selector(es=None):
                    'preschooler or above(>2 years)']
     }]
     if es is not None:
+        import featuretools as ft
+
+        from vbridge.featurization.primitive.age_range import AgeRange
+        from vbridge.featurization.primitive.date import Date
+
         # Build gender selector (feature)
         gender = ft.DirectFeature(ft.IdentityFeature(es["PATIENTS"]["GENDER"]), es['ADMISSIONS'])
         selector_vars[0]['feature'] = gender
@@ -1,5 +1,6 @@
 import os
-from datetime import timedelta
+
+import numpy as np
 
 from vbridge.task.task import Task
 from vbridge.utils.directory_helpers import ROOT
@@ -21,9 +22,12 @@ def pic_48h_in_admission_mortality_task():
         index_col = entity_configs[target_entity]['index']
         time_col = entity_configs[target_entity]['time_index']
         
-        cutoff_time = entity_df.loc[:, [index_col, time_col]]
+        # A shallow copy, since the columns are renamed and replaced rather than modified. The
+        # instance ids keep the index's categorical dtype (shared with the child tables), so
+        # featuretools joins them over the integer codes without casting the ids
+        cutoff_time = entity_df[[index_col, time_col]].copy(deep=False)
         cutoff_time.columns = ['instance_id', 'time']
-        cutoff_time['time'] += timedelta(hours=48)
+        cutoff_time['time'] = cutoff_time['time'].values + np.timedelta64(48, 'h')
         return cutoff_time
 
     return Task(
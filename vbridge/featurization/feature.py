@@ -1,10 +1,11 @@
+import re
 import warnings
+
 import featuretools as ft
 import numpy as np
 import pandas as pd
-from featuretools.selection import (
-    remove_highly_correlated_features, remove_highly_null_features,
-    remove_low_information_features,)
+from featuretools.selection import remove_highly_null_features, remove_low_information_features
+from woodwork.logical_types import Boolean, BooleanNullable
 
 from vbridge.utils.directory_helpers import exist_fm, load_fm, save_fm
 from vbridge.utils.entityset_helpers import find_path
@@ -13,6 +14,46 @@ from vbridge.utils.entityset_helpers import find_path
 warnings.filterwarnings('ignore', category=FutureWarning, module='pandas')
 warnings.filterwarnings('ignore', category=FutureWarning, module='featuretools')
 
+
+def remove_highly_correlated_features(fm, fl=None, pct_corr_threshold=0.95):
+    """Remove the features that are highly correlated with an earlier (less complex) feature.
+
+    Same as featuretools' implementation, but the correlations of all the feature pairs are
+    computed at once instead of with a Series.corr call for each pair.
+    """
+    if fm.ww.schema is None:
+        fm.ww.init()
+    numeric = fm.ww.select(include=['numeric', Boolean, BooleanNullable])
+    dropped = set()
+    if numeric.shape[1] > 1:
+        values = numeric.to_numpy(dtype='float64', na_value=np.nan)
+        if np.isnan(values).any():
+            # Use the pairwise complete observations, like Series.corr
+            corr = pd.DataFrame(values).corr().to_numpy()
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                corr = np.corrcoef(values, rowvar=False)
+        # A feature is dropped if it is correlated with any of the features before it
+        correlated = np.triu(np.abs(corr) >= pct_corr_threshold, k=1).any(axis=0)
+        dropped = set(numeric.columns[correlated])
+    keep = [col for col in fm.columns if col not in dropped]
+    fm = fm[keep]
+    if fl is None:
+        return fm
+    kept_names = set(keep)
+
+    # Keep the features whose columns are kept, and only the kept slices of the multi-output ones
+    kept_fl = []
+    for f in fl:
+        if f.number_output_features > 1:
+            slices = [f[i] for i in range(f.number_output_features)
+                      if f[i].get_name() in kept_names]
+            kept_fl.extend([f] if len(slices) == f.number_output_features else slices)
+        elif f.get_name() in kept_names:
+            kept_fl.append(f)
+    return fm, kept_fl
+
+
 class Featurization:
 
     def __init__(self, es, task):
@@ -20,7 +61,10 @@ class Featurization:
         self.task = task
         self.target_entity = task.target_entity
         self.entity_ids = task.forward_entities + task.backward_entities
-        self.es.add_last_time_indexes()
+        # The last time indexes only need to be computed once for an entity set that is shared
+        # by multiple tasks
+        if any(df.ww.metadata.get('last_time_index') is None for df in self.es.dataframes):
+            self.es.add_last_time_indexes()
 
     @staticmethod
     def select_features(fm, fl=None):
@@ -55,45 +99,53 @@ class Featurization:
 
     @staticmethod
     def remove_uninterpretable_features(fm, fl):
-        where_prefix = set([f.split(' WHERE ')[0] for f in fm.columns if ' WHERE ' in f])
-        uninterpretable_cols = []
-        for column in fm.columns:
-            if np.array([prefix in column for prefix in where_prefix]).any() \
-                    and ' WHERE ' not in column:
-                uninterpretable_cols.append(column)
-        for column in uninterpretable_cols:
-            fm.pop(column)
+        columns = fm.columns.astype(str)
+        has_where = columns.str.contains(' WHERE ', regex=False)
+        where_prefix = set(columns[has_where].str.split(' WHERE ').str[0])
+        if len(where_prefix) == 0:
+            return fm, fl
+        # Match all prefixes in one pass with a single alternation pattern
+        pattern = '|'.join(re.escape(prefix) for prefix in where_prefix)
+        uninterpretable_cols = fm.columns[columns.str.contains(pattern) & ~has_where].tolist()
+        fm.drop(columns=uninterpretable_cols, inplace=True)
         fl = [f for f in fl if f.get_name() in fm.columns]
         return fm, fl
 
     @staticmethod
     def merge_features(fm_list, fl_list):
         index = fm_list[0].index
-        feature_matrix = pd.DataFrame(fm_list[0])
-        feature_list = [f for f in fl_list[0]]
-        for fm, fl in zip(fm_list, fl_list):
+        frames = [fm_list[0]]
+        feature_list = list(fl_list[0])
+        seen = set(fm_list[0].columns)
+        for fm, fl in zip(fm_list[1:], fl_list[1:]):
+            new_cols = []
             for f in fl:
                 col = f.get_name()
-                if col in feature_matrix.columns:
+                if col in seen:
                     continue
-                feature_matrix[col] = fm[col]
+                seen.add(col)
+                new_cols.append(col)
                 feature_list.append(f)
+            frames.append(fm[new_cols])
+        # Concatenate once instead of inserting the columns one by one
+        feature_matrix = pd.concat(frames, axis=1)
         return feature_matrix.loc[index], feature_list
 
     def generate_features(self, save=True, load_exist=False, verbose=True):
         if load_exist and exist_fm(self.task.dataset_id, self.task.task_id):
             fm, fl = load_fm(self.task.dataset_id, self.task.task_id)
         else:
-            fp = []
+            generators = []
             cutoff_time = self.task.get_cutoff_times(self.es)
             if 'PATIENTS' in self.entity_ids:
-                fp.append(self._patients(cutoff_time=cutoff_time, verbose=verbose))
+                generators.append(self._patients)
             if 'CHARTEVENTS' in self.entity_ids:
-                fp.append(self._chart_events(cutoff_time=cutoff_time, verbose=verbose))
+                generators.append(self._chart_events)
             if 'SURGERY_VITAL_SIGNS' in self.entity_ids:
-                fp.append(self._vital_signs(cutoff_time=cutoff_time, verbose=verbose))
+                generators.append(self._vital_signs)
             if 'LABEVENTS' in self.entity_ids:
-                fp.append(self._lab_tests(cutoff_time=cutoff_time, verbose=verbose))
+                generators.append(self._lab_tests)
+            fp = [generate(cutoff_time=cutoff_time, verbose=verbose) for generate in generators]
 
             fm, fl = Featurization.merge_features([f[0] for f in fp], [f[1] for f in fp])
             fm, fl = Featurization.remove_uninterpretable_features(fm, fl)
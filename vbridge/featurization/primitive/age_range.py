@@ -1,11 +1,37 @@
 import featuretools as ft
+import numpy as np
+import pandas as pd
 import woodwork as ww
 from woodwork.column_schema import ColumnSchema
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+    @njit(cache=True)
+    def get_age_bins(days, bins):
+        """Get the bin of each age in days (-1 if it is missing or out of the bins)."""
+        out = np.full(days.shape, -1, dtype=np.int8)
+        for i in range(days.size):
+            for j in range(bins.size - 1):
+                if bins[j] <= days[i] < bins[j + 1]:
+                    out[i] = j
+                    break
+        return out
+else:
+    def get_age_bins(days, bins):
+        """Get the bin of each age in days (-1 if it is missing or out of the bins)."""
+        out = np.searchsorted(bins, days, side='right') - 1
+        out[(out >= bins.size - 1) | np.isnan(days)] = -1
+        return out.astype(np.int8)
+
 
 class AgeRange(ft.primitives.TransformPrimitive):
     """Transform age in days to categorical age ranges."""
-    
+
     name = 'age_range'
     input_types = [ColumnSchema(logical_type=ww.logical_types.Integer, semantic_tags={'numeric'})]
     return_type = ColumnSchema(logical_type=ww.logical_types.Ordinal)
@@ -13,22 +39,21 @@ class AgeRange(ft.primitives.TransformPrimitive):
 
     def __init__(self):
         super().__init__()
-        self.age_ranges = {
-            (0, 4 * 7): "newborn (0–4 weeks)",
-            (4 * 7, 365): "infant (4 weeks - 1 year)",
-            (365, 365 * 2): "toddler (1-2 years)",
-            (365 * 2, float('inf')): "preschooler or above(>2 years)"
-        }
+        self.bins = np.array([0, 4 * 7, 365, 365 * 2, np.inf])
+        self.labels = [
+            "newborn (0–4 weeks)",
+            "infant (4 weeks - 1 year)",
+            "toddler (1-2 years)",
+            "preschooler or above(>2 years)"
+        ]
 
     def get_function(self):
-        def age_range(day):
-            for (lower, upper), category in self.age_ranges.items():
-                if lower <= day < upper:
-                    return category
-            return "unknown"
+        # The last label is used for the ages out of the bins (bin -1)
+        labels = np.array(self.labels + ["unknown"], dtype=object)
 
         def age(column):
             if column is None:
                 return None
-            return column.apply(age_range)
+            bins = get_age_bins(column.to_numpy(dtype=float), self.bins)
+            return pd.Series(labels[bins], index=column.index)
         return age
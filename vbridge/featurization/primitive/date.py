@@ -1,4 +1,3 @@
-import datetime
 import numpy as np
 import pandas as pd
 
@@ -17,11 +16,17 @@ class Date(ft.primitives.TransformPrimitive):
 
     def __init__(self):
         super().__init__()
-        self.reference_date = datetime.date(1997, 1, 1)
+        self.reference_date = np.datetime64('1997-01-01', 'D')
 
     def get_function(self):
         def date(column):
             if column is None:
                 return None
-            return column.apply(lambda row: (row.date() - self.reference_date).days)
+            dates = pd.to_datetime(column).to_numpy().astype('datetime64[D]')
+            days = pd.Series((dates - self.reference_date).astype('int32'), index=column.index)
+            # Keep missing dates missing
+            missing = np.isnat(dates)
+            if missing.any():
+                days = days.astype('Int32').mask(missing)
+            return days
         return date
@@ -1,19 +1,29 @@
 import os
 import pickle
+import threading
+from collections import OrderedDict
+from functools import cached_property
+
 import numpy as np
 
 import pandas as pd
 import shap
 import sklearn
+from joblib import Parallel, delayed
 from sklearn.impute import SimpleImputer
 from sklearn.model_selection import train_test_split, StratifiedShuffleSplit
-from sklearn.preprocessing import MinMaxScaler, OneHotEncoder as SklearnOneHotEncoder
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import (
+    FunctionTransformer, MinMaxScaler, OneHotEncoder as SklearnOneHotEncoder)
 from sklearn.compose import ColumnTransformer
 from sklearn.utils.class_weight import compute_class_weight
 from xgboost import XGBClassifier
 
 from vbridge.utils.directory_helpers import output_workspace
 
+# Number of SHAP explanations cached by each model
+SHAP_CACHE_SIZE = 512
+
 classification_metrics = {
     'Accuracy': sklearn.metrics.accuracy_score,
     'F1 Macro': lambda y_true, y_pred: sklearn.metrics.f1_score(y_true, y_pred, average="macro", zero_division=0),
@@ -36,16 +46,63 @@ def test(model, X, y):
     return scores
 
 
+def get_tree_explainer(model, feature_names=None):
+    """Get a SHAP tree explainer of the XGBoost model.
+
+    The explanations of the models trained on the GPU (device='cuda') are computed there too when
+    cuML is installed.
+    """
+    if model.get_params().get('device', 'cpu').startswith('cuda'):
+        try:
+            from cuml.explainer import TreeExplainer
+        except ImportError:
+            pass
+        else:
+            # Returns numpy arrays for numpy inputs
+            return TreeExplainer(model=model)
+    return shap.TreeExplainer(model, feature_names=feature_names)
+
+
+def fit_model(model, X, y):
+    model.fit(X, y)
+    return model
+
+
 class Model:
-    def __init__(self, topk=10):
-        self._preprocessor = None
+    def __init__(self, topk=10, device='cpu'):
+        self._pipeline = None
         self._feature_names = None
+        self._feature_index = None
         self._model = XGBClassifier(
             eval_metric='logloss',
             enable_categorical=True,
+            # Histogram-based split finding, on the GPU with device='cuda'
+            tree_method='hist',
+            max_bin=256,
+            device=device,
             random_state=42  # Add for reproducibility
         )
         self._explainer = None
+        self._shap_cache = OrderedDict()
+        self._shap_cache_lock = threading.Lock()
+
+    def __getstate__(self):
+        # The cached explanations are not saved with the model (and locks cannot be pickled)
+        state = self.__dict__.copy()
+        state['_shap_cache'] = OrderedDict()
+        del state['_shap_cache_lock']
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('_shap_cache', OrderedDict())
+        if '_feature_index' not in state:
+            state['_feature_index'] = pd.Index(state['_feature_names'] or [])
+        if '_pipeline' not in state:
+            # Models saved before the preprocessing steps were combined into a pipeline
+            state['_pipeline'] = Pipeline([('preprocess', state.pop('_preprocessor')),
+                                           ('scale', state.pop('_scaler'))])
+        self.__dict__.update(state)
+        self._shap_cache_lock = threading.Lock()
 
     @property
     def model(self):
@@ -67,30 +124,33 @@ class Model:
             remainder='drop'  # Drop any remaining columns instead of passthrough
         )
         
-        # Fit and transform the data
-        X_train = preprocessor.fit_transform(X)
-        
-        # Scale the features
-        scaler = MinMaxScaler()
-        X_train = scaler.fit_transform(X_train)
+        # Fit and transform the data, then scale the features. The features are kept dense, since
+        # XGBoost would treat the zeros left out of a sparse matrix as missing values, but cast to
+        # float32, the precision XGBoost works in, before they are scaled
+        self._pipeline = Pipeline([
+            ('preprocess', preprocessor),
+            ('cast', FunctionTransformer(np.asarray, kw_args={'dtype': np.float32})),
+            ('scale', MinMaxScaler())
+        ])
+        X_train = self._pipeline.fit_transform(X)
 
-        # Store the preprocessing pipeline
-        self._preprocessor = preprocessor
-        self._scaler = scaler
-        
         # Get feature names for later use
         num_feature_names = numerical_features
         cat_feature_names = []
         if categorical_features:
-            cat_feature_names = preprocessor.named_transformers_['cat'].get_feature_names_out(categorical_features).tolist()
+            cat_encoder = self._pipeline.named_steps['preprocess'].named_transformers_['cat']
+            cat_feature_names = cat_encoder.get_feature_names_out(categorical_features).tolist()
         self._feature_names = num_feature_names + cat_feature_names
+        # Reused as the columns of the explanations and the transformed data
+        self._feature_index = pd.Index(self._feature_names)
 
+        classes, class_indexes = np.unique(y_train, return_inverse=True)
         weights = compute_class_weight(
             class_weight='balanced',
-            classes=np.unique(y_train),
+            classes=classes,
             y=y_train
         )
-        sample_weight = np.array([weights[np.where(np.unique(y_train) == instance)[0][0]] for instance in y_train])
+        sample_weight = weights[class_indexes]
         
         self._model.fit(
             X_train, 
@@ -98,31 +158,41 @@ class Model:
             sample_weight=sample_weight,
             verbose=False
         )
+        # The explainer and the cached explanations are stale once the model is refitted
+        self._explainer = None
+        with self._shap_cache_lock:
+            self._shap_cache.clear()
 
     def transform(self, X):
-        X = self._preprocessor.transform(X)
-        X = self._scaler.transform(X)
+        X = self._pipeline.transform(X)
         return self._model.predict_proba(X)
 
     def test(self, X, y):
         y_test = y.values
-        X_test = self._preprocessor.transform(X)
-        X_test = self._scaler.transform(X_test)
+        X_test = self._pipeline.transform(X)
         return test(self.model, X_test, y_test)
 
     def SHAP(self, X):
+        # Repeated requests (e.g., for the same patient) reuse the explanations of identical inputs
+        key = (tuple(X.index), tuple(X.columns), int(pd.util.hash_pandas_object(X).sum()))
+        with self._shap_cache_lock:
+            if key in self._shap_cache:
+                self._shap_cache.move_to_end(key)
+                return self._shap_cache[key].copy()
+
+        shap_values = self._compute_shap(X)
+        with self._shap_cache_lock:
+            self._shap_cache[key] = shap_values
+            if len(self._shap_cache) > SHAP_CACHE_SIZE:
+                self._shap_cache.popitem(last=False)
+        return shap_values.copy()
+
+    def _compute_shap(self, X):
         if self._explainer is None:
-            self._explainer = shap.TreeExplainer(
-                self._model,
-                feature_names=self._feature_names
-            )
-        
-        # Store original columns for reference
-        original_columns = X.columns
+            self._explainer = get_tree_explainer(self._model, self._feature_names)
         
         # Transform the data through the preprocessing pipeline
-        X_transformed = self._preprocessor.transform(X)
-        X_transformed = self._scaler.transform(X_transformed)
+        X_transformed = self._pipeline.transform(X)
 
         # Get SHAP values
         shap_values = self._explainer.shap_values(X_transformed)
@@ -132,28 +202,23 @@ class Model:
             # Binary classification - use positive class
             shap_values = shap_values[1]
         
-        # Ensure feature names match the actual SHAP output dimensions
-        if shap_values.shape[1] != len(self._feature_names):
-            # This shouldn't happen, but handle it gracefully
-            feature_names_adjusted = self._feature_names[:shap_values.shape[1]]
-        else:
-            feature_names_adjusted = self._feature_names
-        
+        # Ensure feature names match the actual SHAP output dimensions (the slice only matters if
+        # they do not, which shouldn't happen)
         shap_values = pd.DataFrame(
             shap_values,
-            columns=feature_names_adjusted,
-            index=X.index
+            columns=self._feature_index[:shap_values.shape[1]],
+            index=X.index,
+            copy=False
         )
         
         return shap_values
     
     def get_transformed_data(self, X):
         """Get the transformed data that matches SHAP dimensions."""
-        X_transformed = self._preprocessor.transform(X)
-        X_transformed = self._scaler.transform(X_transformed)
+        X_transformed = self._pipeline.transform(X)
         return pd.DataFrame(
             X_transformed, 
-            columns=self._feature_names[:X_transformed.shape[1]],
+            columns=self._feature_index[:X_transformed.shape[1]],
             index=X.index
         )
 
@@ -161,6 +226,8 @@ class Model:
 class ModelManager:
     def __init__(self, fm, labels=None, task=None):
         self._models = {}
+        self._shap_values = None
+        self._transformed_data = None
         self.dataset_id = task.dataset_id
         self.task_id = task.task_id
         
@@ -186,12 +253,31 @@ class ModelManager:
         for name, label in labels.items():
             self.add_model(label, name=name)
 
+        # Precompute the statistics used to find the out-of-distribution feature values
+        self._feature_stats = None
+        self.get_feature_stats(fm)
+
+    def __getstate__(self):
+        # The statistics hold a reference to the feature matrix, which is not saved
+        state = self.__dict__.copy()
+        state['_feature_stats'] = None
+        state.pop('_X_all', None)
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('_feature_stats', None)
+        state.setdefault('_shap_values', None)
+        state.setdefault('_transformed_data', None)
+        self.__dict__.update(state)
+
     def add_model(self, label, model=None, name=None):
         if name is None:
             name = "model-{}".format(len(self._models))
         if model is None:
             model = Model()
         self._models[name] = model
+        self._shap_values = None
+        self._transformed_data = None
         self.y_train[name] = label.loc[self.y_train.index]
         self.y_test[name] = label.loc[self.y_test.index]
 
@@ -199,15 +285,47 @@ class ModelManager:
     def models(self):
         return self._models
 
+    @cached_property
+    def _X_all(self):
+        # The train/test split is only made in __init__, so the concatenation is never stale
+        return pd.concat([self.X_train, self.X_test])
+
     def fit_all(self):
-        for target_name, model in self._models.items():
-            model.fit(self.X_train, self.y_train[target_name])
+        # Fit the models in parallel processes, sharing the cores between their XGBoost fits
+        n_cpus = os.cpu_count() or 1
+        n_models = max(1, len(self._models))
+        for model in self._models.values():
+            model.model.set_params(n_jobs=max(1, n_cpus // n_models))
+        models = Parallel(n_jobs=min(n_models, n_cpus), backend='loky')(
+            delayed(fit_model)(model, self.X_train, self.y_train[target_name])
+            for target_name, model in self._models.items())
+        # The processes fit copies of the models
+        self._models = dict(zip(self._models, models))
+        # Explain all the instances in one batch, so that the explanations of an instance can be
+        # looked up instead of computed on each request
+        self._shap_values = {target_name: model._compute_shap(self._X_all)
+                             for target_name, model in self._models.items()}
+        self._transformed_data = {
+            target_name: {'train': model.get_transformed_data(self.X_train),
+                          'test': model.get_transformed_data(self.X_test)}
+            for target_name, model in self._models.items()}
 
     def evaluate(self):
         scores = {target_name: model.test(self.X_test, self.y_test[target_name])
                   for target_name, model in self._models.items()}
         return pd.DataFrame(scores).T
 
+    def get_feature_stats(self, fm):
+        """Get the mean, count, std and the 95% reference range ('low', 'high') of the numeric
+        features in the feature matrix. The statistics are cached for the last feature matrix."""
+        if self._feature_stats is None or self._feature_stats[0] is not fm:
+            numeric_cols = fm.select_dtypes(include=[np.number]).columns
+            stat = fm[numeric_cols].agg(['mean', 'count', 'std']).T
+            stat['low'] = stat['mean'] - stat['std'] * 1.96
+            stat['high'] = stat['mean'] + stat['std'] * 1.96
+            self._feature_stats = (fm, stat)
+        return self._feature_stats[1]
+
     def predict_proba(self, X):
         scores = {}
         for target_name, model in self._models.items():
@@ -215,18 +333,24 @@ class ModelManager:
         return scores
 
     def explain(self, id=None, X=None, target=None):
+        if id is not None and self._shap_values is not None:
+            if id not in self.X_train.index and id not in self.X_test.index:
+                raise ValueError("Invalid id.")
+            shap_values = {target_name: sv.loc[[id]]
+                           for target_name, sv in self._shap_values.items()}
+            return shap_values if target is None else shap_values[target]
         if id is not None:
+            # Select a one-row frame, which keeps the column dtypes of the feature matrix
             if id in self.X_train.index:
-                X = self.X_train.loc[id]
+                X = self.X_train.loc[[id]]
             elif id in self.X_test.index:
-                X = self.X_test.loc[id]
+                X = self.X_test.loc[[id]]
             else:
                 raise ValueError("Invalid id.")
-            X = X.to_frame().T
         elif X is not None:
             X = X
         else:
-            X = pd.concat([self.X_train, self.X_test])
+            X = self._X_all
         if target is None:
             return {target: model.SHAP(X) for target, model in self.models.items()}
         else:
@@ -245,6 +369,14 @@ class ModelManager:
         if target is None:
             target = list(self.models.keys())[0]
         
+        if dataset not in ('train', 'test', 'all'):
+            raise ValueError("dataset must be 'train', 'test', or 'all'")
+        if self._transformed_data is not None:
+            transformed = self._transformed_data[target]
+            if dataset == 'all':
+                return pd.concat([transformed['train'], transformed['test']])
+            return transformed[dataset]
+
         model = self.models[target]
         
         if dataset == 'train':
@@ -252,8 +384,7 @@ class ModelManager:
         elif dataset == 'test':
             return model.get_transformed_data(self.X_test)
         elif dataset == 'all':
-            X_all = pd.concat([self.X_train, self.X_test])
-            return model.get_transformed_data(X_all)
+            return model.get_transformed_data(self._X_all)
         else:
             raise ValueError("dataset must be 'train', 'test', or 'all'")
 
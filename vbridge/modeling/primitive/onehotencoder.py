@@ -1,9 +1,22 @@
-import collections
-
+import numpy as np
 import pandas as pd
 from sklearn.base import TransformerMixin
 
 
+def is_list_column(values):
+    """Check whether every row of the column is a list."""
+    return values.map(lambda row: isinstance(row, list)).all()
+
+
+def count_list_items(values):
+    """Count the items in each row of a list-valued column, with one column per item.
+    The counts are saturated to fit in uint8, like the one-hot codes."""
+    items = values.explode().dropna()
+    counts = pd.crosstab(items.index, items.to_numpy())
+    counts = counts.clip(upper=np.iinfo(np.uint8).max).astype(np.uint8)
+    return counts.reindex(values.index, fill_value=0)
+
+
 class OneHotEncoder(TransformerMixin):
     """Encode categorical columns into one-hot/multi-hot codes."""
 
@@ -11,40 +24,41 @@ class OneHotEncoder(TransformerMixin):
         self._dummy_dict = {}
         self._dummy_columns = None
         self._categorical_columns = []
+        self._list_columns = set()
         self.topk = topk
 
     def fit(self, X):
         X = pd.DataFrame(X).copy()
         
-        # Track which columns are categorical
+        # Track which columns are categorical, and which of them hold lists
         self._categorical_columns = []
-        
+        self._list_columns = set()
+
+        dummies_list = []
         for column_name in X.columns:
             if X[column_name].dtype == object:
                 self._categorical_columns.append(column_name)
                 values = X[column_name].copy()
                 
-                if values.apply(lambda row: isinstance(row, list)).all():
-                    counts = values.apply(collections.Counter).reset_index(drop=True)
-                    sub_df = pd.DataFrame.from_records(counts, index=values.index).fillna(0)
-                    selected_dummies = sub_df.sum(axis=0) \
-                        .sort_values(ascending=False).index[:self.topk]
-                    dummies = sub_df[selected_dummies]
-                    others = sub_df[[col for col in sub_df.columns if col not in selected_dummies]]
-                    dummies['Others'] = others.any(axis=1)
+                if is_list_column(values):
+                    self._list_columns.add(column_name)
+                    sub_df = count_list_items(values)
+                    selected_dummies = sub_df.sum(axis=0).nlargest(self.topk).index
+                    others = sub_df.drop(columns=selected_dummies)
+                    dummies = sub_df[selected_dummies] \
+                        .assign(Others=others.any(axis=1).astype(np.uint8))
                 else:
                     counts = values.value_counts(sort=True, ascending=False)
                     selected_dummies = counts[:self.topk].index
                     mask = values.isin(selected_dummies)
                     values[~mask] = "Others"
-                    dummies = pd.get_dummies(values)
+                    dummies = pd.get_dummies(values, dtype=np.uint8)
                     
-                dummies = dummies.add_prefix(column_name + "_")
-                X = X.join(dummies)
+                dummies_list.append(dummies.add_prefix(column_name + "_"))
                 self._dummy_dict[column_name] = selected_dummies
-        
-        # Remove original categorical columns and keep only numeric + dummy columns
-        X = X.drop(columns=self._categorical_columns)
+
+        # Replace the original categorical columns with the dummy columns in a single concat
+        X = pd.concat([X.drop(columns=self._categorical_columns)] + dummies_list, axis=1)
         self._dummy_columns = list(X.columns)
         return self
 
@@ -52,26 +66,33 @@ class OneHotEncoder(TransformerMixin):
         X = pd.DataFrame(X).copy()
         
         # Add dummy columns for each categorical feature
+        dummies_list = []
         for column_name, selected_dummies in self._dummy_dict.items():
-            if column_name in X.columns:
-                values = X[column_name].copy()
-                
-            if values.apply(lambda row: isinstance(row, list)).all():
-                counts = values.apply(collections.Counter).reset_index(drop=True)
-                sub_df = pd.DataFrame.from_records(counts, index=values.index).fillna(0)
-                dummies = sub_df.loc[:, sub_df.columns.isin(selected_dummies)]
-                others = sub_df[[col for col in sub_df.columns if col not in selected_dummies]]
-                dummies['Others'] = others.any(axis=1)
+            if column_name not in X.columns:
+                continue
+            values = X[column_name].copy()
+
+            if column_name in self._list_columns:
+                sub_df = count_list_items(values)
+                others = sub_df.drop(columns=selected_dummies, errors='ignore')
+                # The items missing from X are filled as int64, so cast them back
+                dummies = sub_df.reindex(columns=selected_dummies, fill_value=0) \
+                    .astype(np.uint8) \
+                    .assign(Others=others.any(axis=1).astype(np.uint8))
             else:
                 mask = values.isin(selected_dummies)
                 values[~mask] = "Others"
-                dummies = pd.get_dummies(values)
+                # Encode all the selected values, so that the values missing from X do not need
+                # to be filled (as int64) when reindexing
+                categories = list(dict.fromkeys([*selected_dummies, "Others"]))
+                dummies = pd.get_dummies(values.astype(pd.CategoricalDtype(categories)),
+                                         dtype=np.uint8)
                     
-            dummies = dummies.add_prefix(column_name + "_")
-            X = X.join(dummies)
-        
+            dummies_list.append(dummies.add_prefix(column_name + "_"))
+
         # Remove original categorical columns and return only the expected columns
-        X = X.drop(columns=self._categorical_columns, errors='ignore')
+        X = pd.concat([X.drop(columns=self._categorical_columns, errors='ignore')] + dummies_list,
+                      axis=1)
         return X.reindex(columns=self.dummy_columns, fill_value=0)
 
     @property
@@ -3,6 +3,11 @@ import argparse
 from flask import Flask
 from flask_cors import CORS
 
+try:
+    from flask_compress import Compress
+except ImportError:
+    Compress = None
+
 from vbridge.data_loader.data import create_entityset
 # from vbridge.dataset.pic.tasks.mortality import pic_48h_in_admission_mortality_task
 from vbridge.dataset.mimic_demo.tasks.mortality import mimic_48h_in_admission_mortality_task
@@ -29,6 +34,7 @@ def create_app():
         'cutoff_time': None,
         'feature_matrix': None,
         'feature_list': None,
+        'feature_by_name': None,
         'models': None,
         'selected_ids': None,
         'signal_explainer': None
@@ -44,13 +50,16 @@ def create_app():
                           task.table_dir, verbose=False)
     settings['entityset'] = es
     settings['target_entity'] = task.target_entity
-    settings['cutoff_time'] = task.get_cutoff_times(es)
+    # The patients' cutoff times are looked up with scalar accessors, which need a unique index
+    cutoff_time = task.get_cutoff_times(es)
+    settings['cutoff_time'] = cutoff_time[~cutoff_time.index.duplicated()]
 
     # load features
     feat = Featurization(es, task)
     fm, fl = feat.generate_features(load_exist=True)
     settings['feature_matrix'] = fm
     settings['feature_list'] = fl
+    settings['feature_by_name'] = {f.get_name(): f for f in fl}
 
     # load model
     if ModelManager.exist(task):
@@ -73,7 +82,21 @@ def create_app():
 
     app.settings = settings
     app.json_encoder = NpEncoder
+    # Most resources respond with orjson (see json_response); keep the others compact too
+    app.json.compact = True
     CORS(app, resources={r"/api/*": {"origins": "*"}})
+    if Compress is not None:
+        # The csv records and the predictions of all patients compress well. Streamed responses
+        # (e.g., all temporal records of a patient) are left as is, since compressing them
+        # would buffer the whole body
+        app.config.update(
+            COMPRESS_MIMETYPES=['application/json', 'text/csv'],
+            COMPRESS_ALGORITHM=['zstd', 'gzip'],
+            COMPRESS_LEVEL=4,
+            COMPRESS_MIN_SIZE=1024,
+            COMPRESS_STREAMS=False,
+        )
+        Compress(app)
     add_routes(app)
     return app
 
@@ -10,7 +10,8 @@ LOGGER = logging.getLogger(__name__)
 class SelectorExtent(Resource):
     def __init__(self):
         parser_get = reqparse.RequestParser(bundle_errors=True)
-        parser_get.add_argument('extents', type=str, location='args')
+        # The extents are parsed from their JSON string by the request parser
+        parser_get.add_argument('extents', type=json.loads, location='args', required=True)
         self.parser_get = parser_get
 
     def put(self):
@@ -41,10 +42,10 @@ class SelectorExtent(Resource):
         """
         try:
             args = self.parser_get.parse_args()
-            extents = json.loads(args.get('extents', '[]'))
+            extents = args['extents']
         except Exception as e:
             LOGGER.exception(str(e))
-            return {'message', str(e)}, 400
+            return {'message': str(e)}, 400
 
         try:
             current_app.settings['selector_vars'] = extents
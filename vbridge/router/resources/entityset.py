@@ -27,7 +27,8 @@ def get_entity_description(es, schema, entity_id):
         info['item_index'] = table_info.get('item_index')
         info['value_indexes'] = table_info.get('value_indexes')
         info['alias'] = table_info.get('alias')
-        info['item_dict'] = item_dict.get(entity_id, None)
+        entity_items = item_dict.get(entity_id, None)
+        info['item_dict'] = dict(entity_items) if entity_items is not None else None
         # Updated for modern featuretools API - direct dataframe access
         df = es[entity_id]
         column_names = df.columns
@@ -4,8 +4,7 @@ from flask import current_app, jsonify
 from flask_restful import Resource
 
 from vbridge.utils.entityset_helpers import get_item_dict
-from vbridge.utils.feature_helpers import (
-    get_feature_description, group_features_by_entity, group_features_by_where_item,)
+from vbridge.utils.feature_helpers import describe_features, group_features
 
 LOGGER = logging.getLogger(__name__)
 
@@ -22,12 +21,11 @@ def get_feature_descriptions(fl, es=None, in_hierarchy=True):
         A list of dicts describing features.
     """
     item_dict = get_item_dict(es) if es is not None else None
-    features = [get_feature_description(f, item_dict) for f in fl]
+    features = describe_features(fl, item_dict)
     if in_hierarchy:
         # TODO: A sample grouping schema: entity (e.g., Vital Signs) -> items (e.g., Pulse)
         #  -> specific feature (e.g., mean of Pulse)
-        features = group_features_by_where_item(features)
-        features = group_features_by_entity(features)
+        features = group_features(features)
     return features
 
 
@@ -56,58 +56,39 @@ def get_what_if_shap_values(fm, model_manager, direct_id, target=None):
         shap_values = {}
         targets = model_manager.models.keys() if target is None else [target]
         
-        # Only compute statistics on numeric columns
-        numeric_cols = fm.select_dtypes(include=[np.number]).columns
+        # The statistics of the numeric columns are cached by the model manager
+        stat = model_manager.get_feature_stats(fm)
+        numeric_cols = stat.index
         if len(numeric_cols) == 0:
             # No numeric columns, return empty result
             return {} if target is not None else {t: {} for t in targets}
-        
-        # Compute statistics only on numeric columns
-        numeric_fm = fm[numeric_cols]
-        stat = numeric_fm.agg(['mean', 'count', 'std']).T
-        stat['low'] = stat['mean'] - stat['std'] * 1.96
-        stat['high'] = stat['mean'] + stat['std'] * 1.96
 
         target_fv = fm.loc[direct_id]
+        # Only consider numeric features for perturbation
+        numeric_target_fv = target_fv[numeric_cols]
+        high_features = numeric_cols[(numeric_target_fv > stat['high']).to_numpy()]
+        low_features = numeric_cols[(numeric_target_fv < stat['low']).to_numpy()]
+        features = high_features.append(low_features)
+        if len(features) == 0:
+            return {} if target is not None else {t: {} for t in targets}
+
+        # Perturb each out-of-distribution value to the closest boundary in its own copy of the
+        # feature values, so that all the perturbations are explained in a single batch
+        boundaries = np.concatenate([stat.loc[high_features, 'high'].to_numpy(),
+                                     stat.loc[low_features, 'low'].to_numpy()])
+        values = np.broadcast_to(target_fv.to_numpy(), (len(features), len(fm.columns))).copy()
+        values[np.arange(len(features)), fm.columns.get_indexer(features)] = boundaries
+        perturbed_fm = pd.DataFrame(values, index=features, columns=fm.columns)
+
+        # Get the predictions and shap values for the perturbed features
+        predictions = model_manager.predict_proba(X=perturbed_fm)
+        for target_name in targets:
+            explanations = model_manager.explain(X=perturbed_fm, target=target_name)
+            shap_values[target_name] = {
+                feature: {'shap': float(explanations.at[feature, feature]),
+                          'prediction': float(predictions[target_name][i])}
+                for i, feature in enumerate(features)}
 
-        for target in targets:
-            shap_task = {}
-            # Only consider numeric features for perturbation
-            numeric_target_fv = target_fv[numeric_cols]
-            
-            # Prepare the data for out-of-distribution high values
-            high_features = numeric_target_fv[numeric_target_fv > stat['high']].index
-            if len(high_features) > 0:
-                high_fm = pd.DataFrame(target_fv.values.repeat(len(high_features))
-                                       .reshape(-1, len(high_features)),
-                                       columns=high_features, index=fm.columns)
-                # Perturb the out-of-distribution high values the 'high' boundary
-                for feature in high_features:
-                    high_fm.loc[feature, feature] = stat.loc[feature]['high']
-                # Get the predictions and shap values for the perturbed features
-                explanations = model_manager.explain(X=high_fm.T, target=target)
-                predictions = model_manager.predict_proba(X=high_fm.T)[target]
-                for i, feature in enumerate(high_features):
-                    shap_task[feature] = {'shap': explanations.loc[i, feature],
-                                          'prediction': predictions[i]}
-
-            # Prepare the data for out-of-distribution low values
-            low_features = numeric_target_fv[numeric_target_fv < stat['low']].index
-            if len(low_features) > 0:
-                low_fm = pd.DataFrame(target_fv.values.repeat(len(low_features))
-                                      .reshape(-1, len(low_features)),
-                                      columns=low_features, index=fm.columns)
-                # Perturb the out-of-distribution low values the 'low' boundary
-                for feature in low_features:
-                    low_fm.loc[feature, feature] = stat.loc[feature]['low']
-                # Get the predictions and shap values for the perturbed features
-                explanations = model_manager.explain(X=low_fm.T, target=target)
-                predictions = model_manager.predict_proba(X=low_fm.T)[target]
-                for i, feature in enumerate(low_features):
-                    shap_task[feature] = {'shap': explanations.loc[i, feature],
-                                          'prediction': predictions[i]}
-            shap_values[target] = shap_task
-        
         if target is not None:
             shap_values = shap_values[target]
         return shap_values
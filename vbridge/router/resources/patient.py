@@ -1,12 +1,24 @@
 import logging
+import threading
+from collections import OrderedDict
 
-from flask import current_app, jsonify
+import orjson
+from flask import current_app, stream_with_context
 from flask_restful import Resource, reqparse
 
-from vbridge.utils.entityset_helpers import get_forward_attributes, get_records
+from vbridge.utils.entityset_helpers import (
+    get_forward_attributes, get_records, get_subject_ids,)
+from vbridge.utils.router_helpers import etag_cached, json_response
 
 LOGGER = logging.getLogger(__name__)
 
+RECORDS_CACHE_SIZE = 256
+
+# The serialized records of the recently requested patients, keyed by the entity set, the entity,
+# the subject and the cutoff time
+_records_cache = OrderedDict()
+_records_cache_lock = threading.Lock()
+
 
 def get_statics(es, task, direct_id):
     """Get the 'static' information from a patient.
@@ -26,6 +38,25 @@ def get_statics(es, task, direct_id):
     return records
 
 
+def get_records_csv(es, task, subject_id, entity_id, cutoff_time=None):
+    """Get the records of a subject in an entity as a csv string."""
+    key = (id(es), entity_id, subject_id, cutoff_time)
+    with _records_cache_lock:
+        cached = _records_cache.get(key)
+        if cached is not None and cached[0] is es:
+            _records_cache.move_to_end(key)
+            return cached[1]
+
+    time_index = task.entity_configs[entity_id].get('time_index', None)
+    records = get_records(es, subject_id, entity_id, time_index, cutoff_time=cutoff_time)
+    records = records.to_csv(na_rep='N/A')
+    with _records_cache_lock:
+        _records_cache[key] = (es, records)
+        if len(_records_cache) > RECORDS_CACHE_SIZE:
+            _records_cache.popitem(last=False)
+    return records
+
+
 def get_temporal(es, task, direct_id, entity_id, cutoff_times=None):
     """Get the 'temporal' information from a patient.
 
@@ -40,31 +71,33 @@ def get_temporal(es, task, direct_id, entity_id, cutoff_times=None):
         Returns:
             A dict mapping entity ids to the records in the entity.
     """
-    # Ensure we get scalar values, not Series
-    subject_id_value = es[task.target_entity].loc[direct_id]['SUBJECT_ID']
-    if hasattr(subject_id_value, 'iloc'):
-        subject_id = subject_id_value.iloc[0]
-    else:
-        subject_id = subject_id_value
-        
-    cutoff_time_value = cutoff_times.loc[direct_id, 'time']
-    if hasattr(cutoff_time_value, 'iloc'):
-        cutoff_time = cutoff_time_value.iloc[0]
-    else:
-        cutoff_time = cutoff_time_value
-        
+    subject_id = get_subject_ids(es, task.target_entity)[direct_id]
+    cutoff_time = cutoff_times.at[direct_id, 'time']
+
     if entity_id is None:
-        records = {entity_id: get_records(es, subject_id, entity_id,
-                                          task.entity_configs[entity_id].get('time_index', None),
-                                          cutoff_time=cutoff_time).fillna('N/A').to_csv()
+        records = {entity_id: get_records_csv(es, task, subject_id, entity_id, cutoff_time)
                    for entity_id in task.backward_entities}
     else:
-        time_index = task.entity_configs[entity_id].get('time_index', None)
-        records = get_records(es, subject_id, entity_id, time_index,
-                              cutoff_time=cutoff_time).fillna('N/A').to_csv()
+        records = get_records_csv(es, task, subject_id, entity_id, cutoff_time)
     return records
 
 
+def iter_temporal_json(es, task, direct_id, cutoff_times=None):
+    """Get the json object of get_temporal(..., entity_id=None) as a generator of byte chunks,
+    which serializes the records of one entity at a time. The records are queried before the
+    generator is returned, so that a missing patient or entity raises here."""
+    records = get_temporal(es, task, direct_id, None, cutoff_times)
+
+    def generate():
+        yield b'{'
+        for i, (entity_id, entity_records) in enumerate(records.items()):
+            yield (b',' if i else b'') + orjson.dumps(entity_id) + b':' \
+                + orjson.dumps(entity_records)
+        yield b'}'
+
+    return generate()
+
+
 def get_patient_info(es, task, direct_id, cutoff_times=None):
     return {
         'static': get_statics(es, task, direct_id),
@@ -74,6 +107,7 @@ def get_patient_info(es, task, direct_id, cutoff_times=None):
 
 class StaticInfo(Resource):
 
+    @etag_cached
     def get(self, direct_id):
         """
         Get a patient's static health records
@@ -103,7 +137,7 @@ class StaticInfo(Resource):
         try:
             settings = current_app.settings
             res = get_statics(settings['entityset'], settings['task'], direct_id)
-            res = jsonify(res)
+            res = json_response(res)
         except Exception as e:
             LOGGER.exception(e)
             return {'message': str(e)}, 500
@@ -159,9 +193,16 @@ class TemporalInfo(Resource):
 
         try:
             settings = current_app.settings
-            res = get_temporal(settings['entityset'], settings['task'], direct_id, entity_id,
-                               settings['cutoff_time'])
-            res = jsonify(res)
+            if entity_id is None:
+                # Stream the records of all entities, one entity at a time
+                res = iter_temporal_json(settings['entityset'], settings['task'], direct_id,
+                                         settings['cutoff_time'])
+                res = current_app.response_class(stream_with_context(res),
+                                                 mimetype='application/json')
+            else:
+                res = get_temporal(settings['entityset'], settings['task'], direct_id,
+                                   entity_id, settings['cutoff_time'])
+                res = json_response(res)
         except Exception as e:
             LOGGER.exception(e)
             return {'message': str(e)}, 500
@@ -219,7 +260,7 @@ class Info(Resource):
                 return {'message': f'Patient {direct_id} not found'}, 404
                 
             res = get_patient_info(es, task, direct_id, settings['cutoff_time'])
-            res = jsonify(res)
+            res = json_response(res)
         except Exception as e:
             LOGGER.exception(e)
             return {'message': str(e)}, 500
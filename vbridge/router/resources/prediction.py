@@ -1,29 +1,19 @@
 import logging
-import numpy as np
+import threading
+from collections import OrderedDict
 
-from flask import current_app, jsonify
+from flask import current_app
 from flask_restful import Resource
 
+from vbridge.utils.router_helpers import etag_cached, json_response
+
 LOGGER = logging.getLogger(__name__)
 
+PREDICTION_CACHE_SIZE = 1024
 
-def serialize_numpy_data(obj):
-    """Recursively convert numpy data types to JSON-serializable types"""
-    if isinstance(obj, np.ndarray):
-        return obj.tolist()
-    elif isinstance(obj, (np.int8, np.int16, np.int32, np.int64, 
-                         np.uint8, np.uint16, np.uint32, np.uint64)):
-        return int(obj)
-    elif isinstance(obj, (np.float16, np.float32, np.float64)):
-        return float(obj)
-    elif isinstance(obj, np.bool_):
-        return bool(obj)
-    elif isinstance(obj, dict):
-        return {key: serialize_numpy_data(value) for key, value in obj.items()}
-    elif isinstance(obj, (list, tuple)):
-        return [serialize_numpy_data(item) for item in obj]
-    else:
-        return obj
+# The predictions of the loaded models, keyed by the models, the feature matrix and the patient
+_prediction_cache = OrderedDict()
+_prediction_cache_lock = threading.Lock()
 
 
 def get_prediction_values(models, fm, direct_id=None):
@@ -33,15 +23,26 @@ def get_prediction_values(models, fm, direct_id=None):
         if fm is None:
             raise ValueError("Feature matrix is not loaded")
             
+        key = (id(models), id(fm), direct_id)
+        with _prediction_cache_lock:
+            cached = _prediction_cache.get(key)
+            if cached is not None and cached[0] is models and cached[1] is fm:
+                _prediction_cache.move_to_end(key)
+                return cached[2]
+
         if direct_id is None:
             predictions = models.predict_proba(fm)
         else:
             if direct_id not in fm.index:
                 raise ValueError(f"Patient {direct_id} not found in feature matrix")
-            predictions = models.predict_proba(fm.loc[direct_id].to_frame().T)
-        
-        # Apply comprehensive numpy serialization
-        return serialize_numpy_data(predictions)
+            # A one-row frame keeps the dtypes of the feature matrix
+            predictions = models.predict_proba(fm.loc[[direct_id]])
+
+        with _prediction_cache_lock:
+            _prediction_cache[key] = (models, fm, predictions)
+            if len(_prediction_cache) > PREDICTION_CACHE_SIZE:
+                _prediction_cache.popitem(last=False)
+        return predictions
     except Exception as e:
         LOGGER.error(f"Error in get_prediction_values: {str(e)}")
         raise
@@ -49,6 +50,7 @@ def get_prediction_values(models, fm, direct_id=None):
 
 class Prediction(Resource):
 
+    @etag_cached
     def get(self, direct_id):
         """
         Get the prediction results of a target patient.
@@ -85,7 +87,7 @@ class Prediction(Resource):
             
             res = get_prediction_values(settings["models"], settings['feature_matrix'],
                                         direct_id)
-            return res
+            return json_response(res)
         except Exception as e:
             LOGGER.exception(f"Error in Prediction.get for patient {direct_id}: {str(e)}")
             return {'message': str(e)}, 500
@@ -123,7 +125,7 @@ class AllPrediction(Resource):
             LOGGER.info(f"Feature matrix shape: {settings.get('feature_matrix', 'None').shape if settings.get('feature_matrix') is not None else 'None'}")
             
             res = get_prediction_values(settings["models"], settings['feature_matrix'])
-            return res
+            return json_response(res)
         except Exception as e:
             LOGGER.exception(f"Error in AllPrediction.get: {str(e)}")
             return {'message': str(e)}, 500
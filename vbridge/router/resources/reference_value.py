@@ -1,11 +1,22 @@
 import logging
+import threading
+from collections import OrderedDict
 
 import numpy as np
-from flask import current_app, jsonify
+import pandas as pd
+from flask import current_app
 from flask_restful import Resource
 
+from vbridge.utils.router_helpers import etag_cached, json_response
+
 LOGGER = logging.getLogger(__name__)
 
+REFERENCE_CACHE_SIZE = 64
+
+# The reference values of the recently requested cohorts, keyed by the entity and the cohort
+_REF_CACHE = OrderedDict()
+_REF_CACHE_LOCK = threading.Lock()
+
 
 def get_reference_values_by_entity(es, entity_id, schema, subject_ids=None):
     """Get the reference values for each item in the required entity.
@@ -20,6 +31,13 @@ def get_reference_values_by_entity(es, entity_id, schema, subject_ids=None):
     Returns:
         A dict describing the reference values for each item in the required entity.
     """
+    key = (entity_id, None if subject_ids is None else tuple(subject_ids))
+    with _REF_CACHE_LOCK:
+        cached = _REF_CACHE.get(key)
+        if cached is not None and cached[0] is es:
+            _REF_CACHE.move_to_end(key)
+            return cached[1]
+
     entity_info = schema[entity_id]
     df = es[entity_id]
     # TODO: filter by time
@@ -27,19 +45,42 @@ def get_reference_values_by_entity(es, entity_id, schema, subject_ids=None):
         df = df[df['SUBJECT_ID'].isin(subject_ids)]
     references = {}
     columns = entity_info.get('value_indexes', [])
-    for group in df.groupby(entity_info.get('item_index')):
-        item_name = group[0]
-        item_references = {}
+    if columns:
+        # Aggregate the values of each column with bincount over the item codes (NaN items are
+        # coded as -1), which streams over the values twice instead of once per statistic
+        codes, items = pd.factorize(df[entity_info.get('item_index')], sort=True)
+        observed = codes >= 0
+        codes = codes[observed]
+        n_items = len(items)
+        items = np.asarray(items).tolist()
         for col in columns:
-            mean, count, std = group[1][col].agg(['mean', 'count', 'std'])
-            item_references[col] = {
-                'mean': 0 if np.isnan(mean) else mean,
-                'std': 0 if np.isnan(std) else std,
-                'count': 0 if np.isnan(count) else count,
-                'ci95': [0 if np.isnan(mean - 1.96 * std) else (mean - 1.96 * std),
-                         0 if np.isnan(mean + 1.96 * std) else (mean + 1.96 * std)]
-            }
-            references[item_name] = item_references
+            values = df[col].to_numpy(dtype=float, na_value=np.nan)[observed]
+            valid = ~np.isnan(values)
+            group, values = codes[valid], values[valid]
+            count = np.bincount(group, minlength=n_items)
+            mean = np.divide(np.bincount(group, weights=values, minlength=n_items), count,
+                             out=np.full(n_items, np.nan), where=count > 0)
+            # The sample std, as in pandas
+            sq_dev = np.bincount(group, weights=(values - mean[group]) ** 2, minlength=n_items)
+            std = np.sqrt(np.divide(sq_dev, count - 1, out=np.full(n_items, np.nan),
+                                    where=count > 1))
+            ci_low = np.nan_to_num(mean - 1.96 * std, nan=0).tolist()
+            ci_high = np.nan_to_num(mean + 1.96 * std, nan=0).tolist()
+            mean = np.nan_to_num(mean, nan=0).tolist()
+            std = np.nan_to_num(std, nan=0).tolist()
+            count = count.tolist()
+            for i, item_name in enumerate(items):
+                references.setdefault(item_name, {})[col] = {
+                    'mean': mean[i],
+                    'std': std[i],
+                    'count': count[i],
+                    'ci95': [ci_low[i], ci_high[i]]
+                }
+    with _REF_CACHE_LOCK:
+        _REF_CACHE[key] = (es, references)
+        _REF_CACHE.move_to_end(key)
+        if len(_REF_CACHE) > REFERENCE_CACHE_SIZE:
+            _REF_CACHE.popitem(last=False)
     return references
 
 
@@ -61,6 +102,7 @@ def get_reference_values(es, task, subject_ids=None):
 
 class ReferenceValue(Resource):
 
+    @etag_cached
     def get(self, entity_id):
         """
         Get the reference values for each item in the required entity.
@@ -91,7 +133,7 @@ class ReferenceValue(Resource):
             res = get_reference_values_by_entity(settings['entityset'], entity_id,
                                                  settings['task'].entity_configs,
                                                  settings['selected_ids'])
-            res = jsonify(res)
+            res = json_response(res)
         except Exception as e:
             LOGGER.exception(e)
             return {'message': str(e)}, 500
@@ -101,6 +143,7 @@ class ReferenceValue(Resource):
 
 class ReferenceValues(Resource):
 
+    @etag_cached
     def get(self):
         """
         Get the reference values for each item in are entities used for prediction.
@@ -126,7 +169,7 @@ class ReferenceValues(Resource):
             res = get_reference_values(settings['entityset'],
                                        settings['task'],
                                        settings['selected_ids'])
-            res = jsonify(res)
+            res = json_response(res)
         except Exception as e:
             LOGGER.exception(e)
             return {'message': str(e)}, 500
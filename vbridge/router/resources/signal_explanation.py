@@ -1,48 +1,70 @@
 import logging
+import threading
+from collections import OrderedDict
 
+import numpy as np
+import pandas as pd
 from flask import current_app
 from flask_restful import Resource, reqparse
+from pandas.api.types import is_numeric_dtype
 
 LOGGER = logging.getLogger(__name__)
 
+REFERENCE_STATS_CACHE_SIZE = 64
+
+# The statistics of the features in the recently requested reference cohorts, keyed by the
+# feature matrix and the cohort
+_REFERENCE_STATS_CACHE = OrderedDict()
+_REFERENCE_STATS_CACHE_LOCK = threading.Lock()
+
+
+def get_reference_stats(fm, feature_names, selected_ids=None):
+    """Get the mean of each numeric feature and the mode of each categorical feature in the
+    reference cohort. Only the features whose statistics are not cached yet are aggregated."""
+    key = (id(fm), None if selected_ids is None else tuple(selected_ids))
+    with _REFERENCE_STATS_CACHE_LOCK:
+        cached = _REFERENCE_STATS_CACHE.get(key)
+        stats = cached[1] if cached is not None and cached[0] is fm else {}
+
+    missing = [name for name in dict.fromkeys(feature_names) if name not in stats]
+    if missing:
+        reference_fm = fm.loc[selected_ids, missing] if selected_ids is not None \
+            else fm[missing]
+        numeric_names = [name for name in missing if is_numeric_dtype(fm[name])]
+        categorical_names = [name for name in missing if not is_numeric_dtype(fm[name])]
+        # The cached dict is replaced rather than updated, since other requests may read it
+        stats = {**stats, **reference_fm[numeric_names].mean().to_dict()}
+        modes = reference_fm[categorical_names].mode()
+        stats.update(modes.iloc[0].to_dict() if len(modes)
+                     else dict.fromkeys(categorical_names, np.nan))
+
+    with _REFERENCE_STATS_CACHE_LOCK:
+        _REFERENCE_STATS_CACHE[key] = (fm, stats)
+        _REFERENCE_STATS_CACHE.move_to_end(key)
+        if len(_REFERENCE_STATS_CACHE) > REFERENCE_STATS_CACHE_SIZE:
+            _REFERENCE_STATS_CACHE.popitem(last=False)
+    return stats
+
 
 def get_explain_signal(features, direct_id, fm, ex, selected_ids=None):
-    if selected_ids is not None:
-        reference_fm = fm.loc[selected_ids]
-    else:
-        reference_fm = fm
+    # Skip the features that don't exist in feature matrix
+    features = [f for f in features if f.get_name() in fm.columns]
+
+    # Compare the patient with the reference cohort: the mean of the numeric features and the mode
+    # of the categorical ones
+    feature_names = list(dict.fromkeys(f.get_name() for f in features))
+    stats = get_reference_stats(fm, feature_names, selected_ids)
+    target_values = fm.loc[direct_id, feature_names]
+
     important_segs = []
     for f in features:
         feature_name = f.get_name()
-        
-        # Skip if feature doesn't exist in feature matrix
-        if feature_name not in fm.columns:
-            continue
-            
-        feature_col = fm[feature_name]
-        
-        # Check if this is a categorical feature (contains strings)
-        try:
-            # Get non-null values and check if we have any data
-            non_null_vals = feature_col.dropna()
-            if len(non_null_vals) == 0:
-                # Empty feature - skip
-                flip = False
-            else:
-                sample_val = non_null_vals.iloc[0]
-                float(sample_val)  # This will raise ValueError for non-numeric
-                # Numeric feature - compute mean and std as before
-                mean, std = reference_fm[feature_name].agg(['mean', 'std'])
-                target_value = fm.loc[direct_id, feature_name]
-                flip = target_value < mean
-        except (ValueError, TypeError):
-            # Categorical feature - use mode instead of mean
-            mode_val = reference_fm[feature_name].mode()
-            target_value = fm.loc[direct_id, feature_name]
-            if len(mode_val) > 0:
-                flip = target_value != mode_val.iloc[0]
-            else:
-                flip = False
+        target_value = target_values[feature_name]
+        if is_numeric_dtype(fm[feature_name]):
+            flip = bool(target_value < stats[feature_name])
+        else:
+            mode_val = stats[feature_name]
+            flip = not pd.isna(mode_val) and bool(target_value != mode_val)
         
         # Try to use the actual explainer, but fall back to mock data if it fails
         try:
@@ -139,13 +161,16 @@ class SignalExplanation(Resource):
                 return []
             
             # Safely find features that exist in the feature list
+            feature_by_name = settings.get('feature_by_name')
+            if feature_by_name is None:
+                feature_by_name = {f.get_name(): f for f in fl}
             features = []
             for f_name in feature_names:
-                matching_features = [f for f in fl if f.get_name() == f_name]
-                if matching_features:
-                    features.append(matching_features[0])
-                else:
+                feature = feature_by_name.get(f_name)
+                if feature is None:
                     LOGGER.warning(f"Feature {f_name} not found in feature list")
+                elif f_name in fm.columns:
+                    features.append(feature)
             
             if not features:
                 return []  # Return empty array instead of error
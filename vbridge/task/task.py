@@ -13,6 +13,7 @@ class Task:
         # For Featurization
         self._target_entity = target_entity
         self._cutoff_times_fn = cutoff_times_fn
+        self._cutoff_times_cache = None
         self._backward_entities = backward_entities
         self._forward_entities = forward_entities
         self._ignore_variables = ignore_variables
@@ -68,7 +69,10 @@ class Task:
         return self._target_entity
 
     def get_cutoff_times(self, es):
-        return self._cutoff_times_fn(es)
+        # Only compute the cutoff times once per entity set; callers get their own copy
+        if self._cutoff_times_cache is None or self._cutoff_times_cache[0] is not es:
+            self._cutoff_times_cache = (es, self._cutoff_times_fn(es))
+        return self._cutoff_times_cache[1].copy()
 
     @property
     def backward_entities(self):
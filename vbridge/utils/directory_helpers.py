@@ -1,3 +1,4 @@
+import json
 import os
 import pathlib
 import pickle
@@ -9,22 +10,43 @@ ROOT = os.getcwd()
 output_workspace = os.path.join(ROOT, 'output')
 
 
-def save_entityset(entityset, dataset_id=''):
+def save_entityset(entityset, dataset_id='', mtimes=None):
     output_dir = os.path.join(output_workspace, dataset_id)
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
     with open(os.path.join(output_dir, 'entityset.pkl'), 'wb') as f:
         pickle.dump(entityset, f)
+    if mtimes is not None:
+        # Record the source tables' mtimes so that stale pickles can be detected
+        with open(os.path.join(output_dir, 'entityset.mtime'), 'w') as f:
+            json.dump(mtimes, f)
 
 
 def load_entityset(dataset_id=''):
     output_dir = os.path.join(output_workspace, dataset_id)
     with open(os.path.join(output_dir, 'entityset.pkl'), 'rb') as f:
-        return pickle.load(f)
-
-
-def exist_entityset(dataset_id=''):
+        entityset = pickle.load(f)
+    # Featuretools' features look the entity set up by its id, which unpickling does not register,
+    # so rebuild the entity set from its typed dataframes
+    import featuretools as ft
+    return ft.EntitySet(
+        id=entityset.id,
+        dataframes={name: (df,) for name, df in entityset.dataframe_dict.items()},
+        relationships=[(r['parent_dataframe_name'], r['parent_column_name'],
+                        r['child_dataframe_name'], r['child_column_name'])
+                       for r in (rel.to_dictionary() for rel in entityset.relationships)])
+
+
+def exist_entityset(dataset_id='', mtimes=None):
     output_dir = os.path.join(output_workspace, dataset_id)
-    return os.path.exists(os.path.join(output_dir, 'entityset.pkl'))
+    if not os.path.exists(os.path.join(output_dir, 'entityset.pkl')):
+        return False
+    if mtimes is None:
+        return True
+    mtime_path = os.path.join(output_dir, 'entityset.mtime')
+    if not os.path.exists(mtime_path):
+        return False
+    with open(mtime_path) as f:
+        return json.load(f) == mtimes
 
 
 def save_fm(df, fm_list, dataset_id='', task_id='', token=''):
@@ -1,10 +1,52 @@
+import functools
+import threading
+import weakref
+from types import MappingProxyType
+
+import numpy as np
+
+# The results of the memoized functions of each entity set, keyed by the identity of the entity
+# set. Entity sets are unhashable, so a finalizer drops their entry once they are collected.
+_ENTITYSET_CACHE = {}
+_ENTITYSET_CACHE_LOCK = threading.Lock()
+
+
+def _freeze(value):
+    """Get a read-only view of a (nested) result, which is shared by all callers."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    return value
+
+
+def cached_on_entityset(func):
+    """Memoize a function of the (immutable) entity set and hashable arguments. The results are
+    returned as read-only tuples and mappings, and dropped together with the entity set."""
+
+    @functools.wraps(func)
+    def wrapper(entityset, *args):
+        with _ENTITYSET_CACHE_LOCK:
+            cache = _ENTITYSET_CACHE.get(id(entityset))
+            if cache is None:
+                cache = _ENTITYSET_CACHE[id(entityset)] = {}
+                weakref.finalize(entityset, _ENTITYSET_CACHE.pop, id(entityset), None)
+        key = (func.__name__,) + args
+        if key not in cache:
+            cache.setdefault(key, _freeze(func(entityset, *args)))
+        return cache[key]
+
+    return wrapper
+
+
 def remove_nan_entries(df, key_columns, verbose=True):
-    n_row = len(df)
-    for column in key_columns:
-        df = df[df[column] == df[column]]
+    mask = df[key_columns].notna().all(axis=1).to_numpy()
     if verbose:
-        print("Prune ({}/{}) rows.".format(n_row - len(df), n_row))
-    return df
+        print("Prune ({}/{}) rows.".format(len(df) - mask.sum(), len(df)))
+    # Only copy the table when there are rows to remove
+    return df if mask.all() else df[mask]
 
 
 def parse_relationship_path(relationship):
@@ -17,6 +59,7 @@ def parse_relationship_path(relationship):
     }
 
 
+@cached_on_entityset
 def get_forward_entities(entityset, entity_id):
     ids = []
     entity_id_pipe = [entity_id]
@@ -56,6 +99,7 @@ def get_forward_attributes(entityset, target_entity, direct_id, interesting_ids=
     return info
 
 
+@cached_on_entityset
 def find_path(entityset, source_entity, target_entity):
     """Find a path of the source entity to the target_entity."""
     nodes_pipe = [target_entity]
@@ -85,20 +129,24 @@ def find_path(entityset, source_entity, target_entity):
     return paths
 
 
+@cached_on_entityset
+def get_relationship_index(entityset):
+    """Get a dict mapping the (parent, child) dataframe names to their relationship."""
+    relationships = {}
+    for r in entityset.relationships:
+        relationships.setdefault((r.parent_dataframe.ww.name, r.child_dataframe.ww.name), r)
+    return relationships
+
+
 def transfer_cutoff_times(entityset, cutoff_times, source_entity, target_entity,
                           reduce="latest"):
     path = find_path(entityset, source_entity, target_entity)[-1]
+    relationships = get_relationship_index(entityset)
     for i, source in enumerate(path[:-1]):
         target = path[i + 1]
-        # Use modern featuretools API for relationships
-        options = list(filter(lambda r: (r.child_dataframe.ww.name == source
-                                         and r.parent_dataframe.ww.name == target)
-                              or (r.parent_dataframe.ww.name == source
-                                  and r.child_dataframe.ww.name == target),
-                              entityset.relationships))
-        if len(options) == 0:
+        r = relationships.get((target, source), relationships.get((source, target)))
+        if r is None:
             raise ValueError("No Relationship between {} and {}".format(source, target))
-        r = options[0]
         if target == r.child_dataframe.ww.name:
             # Transfer cutoff_times to "child", e.g., PATIENTS -> ADMISSIONS
             # Updated for modern featuretools API - direct dataframe access
@@ -110,9 +158,9 @@ def transfer_cutoff_times(entityset, cutoff_times, source_entity, target_entity,
             # Updated for modern featuretools API - direct dataframe access
             cutoff_times[r.child_column] = entityset[r.child_dataframe.ww.name][r.child_column]
             if reduce == "latest":
-                idx = cutoff_times.groupby(r.child_column).time.idxmax().values
+                idx = cutoff_times.groupby(r.child_column, observed=True).time.idxmax().values
             elif reduce == 'earist':
-                idx = cutoff_times.groupby(r.child_column).time.idxmin().values
+                idx = cutoff_times.groupby(r.child_column, observed=True).time.idxmin().values
             else:
                 raise ValueError("Unknown reduce option.")
             cutoff_times = cutoff_times.loc[idx]
@@ -121,13 +169,26 @@ def transfer_cutoff_times(entityset, cutoff_times, source_entity, target_entity,
     return cutoff_times
 
 
+@cached_on_entityset
+def get_subject_ids(entityset, entity_id):
+    """Get a dict mapping the indexes of the entity to their SUBJECT_IDs."""
+    return entityset[entity_id]['SUBJECT_ID'].to_dict()
+
+
+@cached_on_entityset
+def get_subject_positions(entityset, entity_id):
+    """Get a dict mapping each SUBJECT_ID to the positions of its records in the entity."""
+    return entityset[entity_id].groupby('SUBJECT_ID', observed=True).indices
+
+
 def get_records(entityset, subject_id, entity_id, time_index=None, cutoff_time=None):
     # Updated for modern featuretools API - direct dataframe access
     entity = entityset[entity_id]
 
     # select records by SUBJECT_ID
     if 'SUBJECT_ID' in entity.columns:
-        entity_df = entity[entity['SUBJECT_ID'] == subject_id]
+        positions = get_subject_positions(entityset, entity_id).get(subject_id)
+        entity_df = entity.iloc[positions if positions is not None else []]
     else:
         entity_df = entity
 
@@ -139,12 +200,14 @@ def get_records(entityset, subject_id, entity_id, time_index=None, cutoff_time=N
     return entity_df
 
 
+@cached_on_entityset
 def get_item_dict(es):
     # Updated for modern featuretools API - direct dataframe access
     item_dict = {'LABEVENTS': es['D_LABITEMS'].loc[:, 'LABEL'].to_dict()}
+    # Split the items by the entities they link to in a single pass
+    # TODO: Change 'LABEL' to 'LABEL_CN' for Chinese labels
+    linked_items = {link: items.to_dict() for link, items
+                    in es['D_ITEMS'].groupby('LINKSTO', observed=True)['LABEL']}
     for entity_id in ['CHARTEVENTS', 'SURGERY_VITAL_SIGNS']:
-        df = es['D_ITEMS']
-        # TODO: Change 'LABEL' to 'LABEL_CN' for Chinese labels
-        items = df[df['LINKSTO'] == entity_id.lower()].loc[:, 'LABEL']
-        item_dict[entity_id] = items.to_dict()
+        item_dict[entity_id] = linked_items.get(entity_id.lower(), {})
     return item_dict
@@ -1,102 +1,255 @@
-from copy import deepcopy
+import functools
+import threading
+import weakref
 
+# The columns that do not define what a feature is about (e.g., the time index of TREND)
+_DEFAULT_IGNORE_COLUMNS = frozenset(['CHARTTIME', 'chartime'])
 
+# The results of the memoized functions of each feature. Features are hashed by their identity,
+# so the entries are dropped once the features are collected.
+_FEATURE_CACHE = weakref.WeakKeyDictionary()
+_FEATURE_CACHE_LOCK = threading.Lock()
+
+
+def cached_on_feature(func):
+    """Memoize a function of a feature and hashable arguments. The results are dropped together
+    with the feature."""
+
+    @functools.wraps(func)
+    def wrapper(feature, *args):
+        with _FEATURE_CACHE_LOCK:
+            cache = _FEATURE_CACHE.get(feature)
+            if cache is None:
+                cache = _FEATURE_CACHE[feature] = {}
+        key = (func.__name__,) + args
+        if key not in cache:
+            cache.setdefault(key, func(feature, *args))
+        return cache[key]
+
+    return wrapper
+
+
+@cached_on_feature
+def get_feature_name(feature):
+    return feature.get_name()
+
+
+@cached_on_feature
 def get_leaves(feature):
-    if len(feature.base_features) > 0:
-        return [f for feat in feature.base_features for f in get_leaves(feat)]
-    else:
-        return [feature]
+    # Walk the feature tree with an explicit stack, keeping the leaves in left-to-right order
+    leaves = []
+    stack = [feature]
+    while stack:
+        feature = stack.pop()
+        if len(feature.base_features) > 0:
+            stack.extend(reversed(feature.base_features))
+        else:
+            leaves.append(feature)
+    return tuple(leaves)
 
 
+@cached_on_feature
 def get_relevant_entity_id(feature):
-    leave_nodes = get_leaves(feature)
     # Updated for modern featuretools 1.0+ API - use dataframe_name instead of entity_id
-    entity_ids = list(set([leaf.dataframe_name for leaf in leave_nodes]))
-    if len(entity_ids) > 1:
-        raise UserWarning("The system do not support features constructed with data from "
-                          "multiple entities. Will choose the first entity instead.")
+    entity_ids = []
+    for leaf in get_leaves(feature):
+        if leaf.dataframe_name not in entity_ids:
+            entity_ids.append(leaf.dataframe_name)
+            if len(entity_ids) > 1:
+                raise UserWarning("The system do not support features constructed with data "
+                                  "from multiple entities. Will choose the first entity instead.")
     return entity_ids[0]
 
 
 def get_relevant_column_id(feature, ignore_columns=None):
-    leave_nodes = get_leaves(feature)
+    if not isinstance(ignore_columns, frozenset):
+        ignore_columns = frozenset(ignore_columns or ())
+    return _get_relevant_column_id(feature, ignore_columns)
+
+
+@cached_on_feature
+def _get_relevant_column_id(feature, ignore_columns):
     # Updated for modern featuretools 1.0+ API - use column_name instead of variable.id
-    column_ids = list(set([leaf.column_name for leaf in leave_nodes]))
-    if ignore_columns is not None:
-        column_ids = [col for col in column_ids if col not in ignore_columns]
-    if len(column_ids) > 1:
-        raise UserWarning("The system do not support features constructed with data from "
-                          "multiple variables. Will choose the first variable instead.")
+    column_ids = []
+    for leaf in get_leaves(feature):
+        if leaf.column_name not in ignore_columns and leaf.column_name not in column_ids:
+            column_ids.append(leaf.column_name)
+            if len(column_ids) > 1:
+                raise UserWarning("The system do not support features constructed with data "
+                                  "from multiple variables. Will choose the first variable "
+                                  "instead.")
     return column_ids[0]
 
 
-def get_feature_description(feature, item_dict=None, ignore_columns=None):
+def _as_ignore_columns(ignore_columns):
     if ignore_columns is None:
-        ignore_columns = ['CHARTTIME', 'chartime']
-    info = {
-        'id': feature.get_name(),
-        'primitive': feature.primitive.name,
-        'entityId': get_relevant_entity_id(feature),
-        'columnId': get_relevant_column_id(feature, ignore_columns=ignore_columns),
-    }
-    info['alias'] = info['columnId']
-    info['desc'] = info['columnId']
-
-    if 'where' in feature.__dict__:
-        filter_name = feature.where.get_name()
-        info['item'] = {
-            'columnId': filter_name.split(' = ')[0],
-            'itemId': filter_name.split(' = ')[1],
+        return _DEFAULT_IGNORE_COLUMNS
+    return frozenset(ignore_columns)
+
+
+def get_feature_description(feature, item_dict=None, ignore_columns=None):
+    return _describe_feature(feature, item_dict, _as_ignore_columns(ignore_columns))
+
+
+def describe_features(features, item_dict=None, ignore_columns=None):
+    """Get the descriptions of a list of features.
+
+    Args:
+        features: list, a list of featuretools features.
+        item_dict: dict, the item alias of each item id, grouped by entities.
+        ignore_columns: iterable, the columns that are not used to describe the features.
+
+    Returns:
+        A list of dicts describing features.
+    """
+    ignore_columns = _as_ignore_columns(ignore_columns)
+    return [_describe_feature(f, item_dict, ignore_columns) for f in features]
+
+
+def _describe_feature(feature, item_dict, ignore_columns):
+    feature_id = get_feature_name(feature)
+    primitive = feature.primitive.name
+    entity_id = get_relevant_entity_id(feature)
+    column_id = _get_relevant_column_id(feature, ignore_columns)
+    where = getattr(feature, 'where', None)
+    if where is None:
+        return {
+            'id': feature_id,
+            'primitive': primitive,
+            'entityId': entity_id,
+            'columnId': column_id,
+            'alias': column_id,
+            'desc': column_id,
         }
-        info['alias'] = feature.primitive.name
-        info['desc'] = "{}({})".format(feature.primitive.name, info['item']['itemId'])
-        if item_dict is not None:
-            item_dict = item_dict.get(info['entityId'])
-            info['item']['itemAlias'] = item_dict.get(str(info['item']['itemId']), None)
-            info['desc'] = "{}({})".format(feature.primitive.name, info['item']['itemAlias'])
-    return info
+
+    # The filter is named as '<column> = <item>', where the item may contain ' = '
+    item_column_id, _, item_id = get_feature_name(where).partition(' = ')
+    item = {
+        'columnId': item_column_id,
+        'itemId': item_id,
+    }
+    if item_dict is not None:
+        item['itemAlias'] = item_dict.get(entity_id).get(str(item_id), None)
+    return {
+        'id': feature_id,
+        'primitive': primitive,
+        'entityId': entity_id,
+        'columnId': column_id,
+        'alias': primitive,
+        'desc': "{}({})".format(primitive, item.get('itemAlias', item_id)),
+        'item': item,
+    }
 
 
 def group_features_by_where_item(features):
-    grouped_features = deepcopy(features)
-    where_item_group = {}
+    # Only the top-level fields are written, so shallow copies are enough
+    grouped_features = [dict(f) for f in features]
+    item_children = {}
+    item_parent_idx = {}
     for i, f in enumerate(features):
         if 'parentId' not in f and 'item' in f:
             itemId = f['item']['itemId']
-            if itemId in where_item_group:
-                where_item_group[itemId][0]['childrenIds'].append(i)
-                grouped_features[i]['parentId'] = where_item_group[itemId][1]
+            if itemId in item_children:
+                item_children[itemId].append(i)
             else:
-                group_node = deepcopy(f)
+                group_node = dict(f)
                 group_node['id'] = itemId
                 group_node['primitive'] = None
-                group_node['childrenIds'] = [i]
+                group_node['childrenIds'] = item_children[itemId] = [i]
                 group_node['alias'] = f['item']['itemAlias']
+                item_parent_idx[itemId] = len(grouped_features)
                 grouped_features.append(group_node)
-                where_item_group[itemId] = (group_node, len(grouped_features))
-                grouped_features[i]['parentId'] = where_item_group[itemId][1]
+            grouped_features[i]['parentId'] = item_parent_idx[itemId]
     return grouped_features
 
 
 def group_features_by_entity(features):
-    grouped_features = deepcopy(features)
-    entity_group = {}
+    # Only the top-level fields are written, so shallow copies are enough
+    grouped_features = [dict(f) for f in features]
+    entity_children = {}
+    entity_parent_idx = {}
     for i, f in enumerate(features):
         if 'parentId' in f:
             continue
         entityId = f['entityId']
-        if entityId in entity_group:
-            entity_group[entityId][0]['childrenIds'].append(i)
-            grouped_features[i]['parentId'] = entity_group[entityId][1]
+        if entityId in entity_children:
+            entity_children[entityId].append(i)
         else:
-            group_node = deepcopy(f)
+            group_node = dict(f)
             group_node['id'] = entityId
             group_node['primitive'] = None
             group_node['columnId'] = None
             group_node['item'] = None
             group_node['alias'] = entityId
-            group_node['childrenIds'] = [i]
+            group_node['childrenIds'] = entity_children[entityId] = [i]
+            entity_parent_idx[entityId] = len(grouped_features)
             grouped_features.append(group_node)
-            entity_group[entityId] = (group_node, len(grouped_features))
-            grouped_features[i]['parentId'] = entity_group[entityId][1]
+        grouped_features[i]['parentId'] = entity_parent_idx[entityId]
     return grouped_features
+
+
+def group_features(features):
+    """Group the features by their where items and then by their entities, which is equivalent to
+    group_features_by_entity(group_features_by_where_item(features)) with a single copy."""
+    return list(iter_grouped_features(features))
+
+
+def iter_grouped_features(features):
+    """Yield the entries of group_features(features) one by one. Only the group nodes are kept
+    in memory; each feature is copied when it is yielded."""
+    n_features = len(features)
+    item_children = {}
+    item_parent_idx = {}
+    item_nodes = []
+    # The features without an item group, followed by the item groups, are grouped by entities
+    entity_members = []
+    for i, f in enumerate(features):
+        if 'parentId' in f:
+            continue
+        if 'item' not in f:
+            entity_members.append(i)
+            continue
+        itemId = f['item']['itemId']
+        if itemId in item_children:
+            item_children[itemId].append(i)
+        else:
+            group_node = dict(f)
+            group_node['id'] = itemId
+            group_node['primitive'] = None
+            group_node['childrenIds'] = item_children[itemId] = [i]
+            group_node['alias'] = f['item']['itemAlias']
+            item_parent_idx[itemId] = n_features + len(item_nodes)
+            item_nodes.append(group_node)
+
+    entity_children = {}
+    entity_parent_idx = {}
+    entity_nodes = []
+    for i in entity_members + list(item_parent_idx.values()):
+        f = features[i] if i < n_features else item_nodes[i - n_features]
+        entityId = f['entityId']
+        if entityId in entity_children:
+            entity_children[entityId].append(i)
+        else:
+            group_node = dict(f)
+            group_node['id'] = entityId
+            group_node['primitive'] = None
+            group_node['columnId'] = None
+            group_node['item'] = None
+            group_node['alias'] = entityId
+            group_node['childrenIds'] = entity_children[entityId] = [i]
+            entity_parent_idx[entityId] = n_features + len(item_nodes) + len(entity_nodes)
+            entity_nodes.append(group_node)
+        if i >= n_features:
+            f['parentId'] = entity_parent_idx[entityId]
+
+    for f in features:
+        # Only the top-level fields are written, so shallow copies are enough
+        f = dict(f)
+        if 'parentId' not in f:
+            if 'item' in f:
+                f['parentId'] = item_parent_idx[f['item']['itemId']]
+            else:
+                f['parentId'] = entity_parent_idx[f['entityId']]
+        yield f
+    yield from item_nodes
+    yield from entity_nodes
@@ -1,7 +1,11 @@
 import datetime
+import functools
+import hashlib
 import json
 
 import numpy as np
+import orjson
+from flask import Response, current_app, request
 
 
 # From https://stackoverflow.com/questions/50916422/python-typeerror-object-of-type-int64-is-not
@@ -36,6 +40,40 @@ class NpEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
+def _orjson_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return obj.__str__()
+    elif isinstance(obj, np.void):
+        return None
+    return NpEncoder().default(obj)
+
+
+def json_response(obj):
+    """Serialize the object with orjson, which handles the numpy scalars and arrays natively,
+    into a compact json response."""
+    data = orjson.dumps(obj, default=_orjson_default,
+                        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+                        | orjson.OPT_PASSTHROUGH_DATETIME)
+    return current_app.response_class(data, mimetype='application/json')
+
+
+def etag_cached(get):
+    """Tag the successful responses of a resource's getter with a weak ETag of their content,
+    and answer the requests whose If-None-Match matches it with an empty 304 response."""
+
+    @functools.wraps(get)
+    def wrapper(*args, **kwargs):
+        res = get(*args, **kwargs)
+        if isinstance(res, Response) and res.status_code == 200:
+            res.set_etag(hashlib.blake2b(res.get_data(), digest_size=8).hexdigest(), weak=True)
+            res.cache_control.private = True
+            res.cache_control.max_age = 60
+            res.make_conditional(request)
+        return res
+
+    return wrapper
+
+
 class ApiError(Exception):
     """
     API error handler Exception